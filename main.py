@@ -1,31 +1,26 @@
 import functools
+import hashlib
 import os
-from flask import Flask, render_template, redirect, url_for, flash, request, abort
+from flask import Flask, render_template, stream_template, redirect, url_for, request, abort
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
 from datetime import date
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
-from sqlalchemy import ForeignKey
+from sqlalchemy.orm import relationship, joinedload, selectinload, raiseload, load_only
+from sqlalchemy import ForeignKey, select, func, insert, update
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
-from flask_gravatar import Gravatar
-from flask_bcrypt import Bcrypt
+from flask_session import Session
+from flask_caching import Cache
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 
 ckeditor = CKEditor()
-bcrypt = Bcrypt()  # Apply Bcrypt configurations to the app (enable Bcrypt features)
+ph = PasswordHasher(time_cost=2, memory_cost=46 * 1024, parallelism=1)  # Argon2id, OWASP-recommended parameters
 db = SQLAlchemy()
 login_manager = LoginManager()
-
-gravatar = Gravatar(
-                    size=500,
-                    rating='g',
-                    default='retro',
-                    force_default=False,
-                    force_lower=False,
-                    use_ssl=False,
-                    base_url=None)
+server_session = Session()
+cache = Cache()
 
 def create_app():
     app = Flask(__name__)
@@ -35,14 +30,35 @@ def create_app():
     ##CONNECT TO DB
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['internal']
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_pre_ping': True,  # replace connections the database has dropped instead of failing the request
+        'pool_size': 4,  # one connection per gunicorn thread (see Procfile)
+        'max_overflow': 2,
+        'pool_recycle': 1800,
+        'pool_timeout': 5,
+    }
+
+    ##STORE SESSIONS AND CACHED PAGES IN REDIS
+    if 'REDIS_URL' in os.environ:
+        import redis  # only imported when a Redis server is configured
+        app.config['SESSION_TYPE'] = 'redis'
+        app.config['SESSION_REDIS'] = redis.Redis.from_url(os.environ['REDIS_URL'])
+        server_session.init_app(app)
+
+        app.config['CACHE_TYPE'] = 'RedisCache'
+        app.config['CACHE_REDIS_URL'] = os.environ['REDIS_URL']
+        app.config['CACHE_KEY_PREFIX'] = 'blog_'  # keeps cache.clear() away from session keys
+
+    # Without Redis, sessions stay in signed cookies and page caching is disabled so every worker sees post changes immediately
+    else:
+        app.config['CACHE_TYPE'] = 'NullCache'
 
-
+    login_manager.login_view = 'login'  # redirect anonymous visitors of protected pages to the login form
     login_manager.init_app(app)  # Apply login_manager configurations to the app (enable login features)
     ckeditor.init_app(app)
     Bootstrap(app)
-    bcrypt.init_app(app)
+    cache.init_app(app)
     db.init_app(app)
-    gravatar.init_app(app)
     return app
 
 app = create_app()
@@ -63,7 +79,7 @@ class BlogPost(db.Model):
 
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
 
@@ -80,6 +96,11 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(250), unique=True, nullable=False)
     password = db.Column(db.String(250), nullable=False)
     name = db.Column(db.String(250), nullable=False)
+    is_admin = db.Column(db.Boolean, nullable=False, default=False)
+    gravatar_hash = db.Column(db.String(32), nullable=False)  # MD5 of the email, computed once at registration
+
+    # Case-insensitive index used by the login lookup
+    __table_args__ = (db.Index("ix_users_email_lower", func.lower(email), unique=True),)
 
 class Comment(db.Model):
     __tablename__ = "comments"
@@ -88,48 +109,91 @@ class Comment(db.Model):
     text = db.Column(db.Text, nullable=False)
 
     author_id = db.Column(ForeignKey("users.id"))
-    author = relationship("User", back_populates="comments")
+    author = relationship("User", back_populates="comments", lazy="raise")  # must be loaded explicitly in queries
 
     blog_id = db.Column(ForeignKey("blog_posts.id"))
-    b_post = relationship("BlogPost", back_populates="comments")
+    b_post = relationship("BlogPost", back_populates="comments", lazy="raise")
 
 
 
 def admin_only(func):
+    """This decorator limits a view to the admin; anonymous visitors are sent to the login page before any admin check"""
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        if current_user.__dict__.get('id') == 1:
+        if getattr(current_user, 'is_admin', False):
             return func(*args, **kwargs)
         else:
             return abort(403)
-    return wrapper
+    return login_required(wrapper)
+
+def clear_page_cache():
+    """This function drops cached pages after blog posts are created, edited or deleted"""
+    cache.clear()
+
+def verify_password(user, password):
+    """This function checks a password against the user's stored hash, upgrading the hash to current Argon2 parameters if needed"""
+    try:
+        ph.verify(user.password, password)
+    except InvalidHashError:
+        # Accounts created before the switch to Argon2 still hold bcrypt hashes
+        import bcrypt  # only needed for these legacy accounts
+        try:
+            if not bcrypt.checkpw(password.encode('utf-8'), user.password.encode('utf-8')):
+                return False
+        except ValueError:  # stored value is neither an Argon2 nor a bcrypt hash
+            return False
+    except VerificationError:
+        return False
+    else:
+        if not ph.check_needs_rehash(user.password):
+            return True
+
+    # Re-hash with Argon2 now that the plain password is known
+    user.password = ph.hash(password)
+    db.session.commit()
+    return True
 
 @login_manager.user_loader
 def load_user(user_id):
     """This function takes a numerical id and returns the database entry associated with that id"""
-    return User.query.filter_by(id=user_id).first()  # searches for entries by id, and return the first entry found
+    return db.session.get(User, int(user_id))  # primary key lookup, served from the session's identity map when already loaded
 
 
 @app.route('/')
+@cache.cached(timeout=300, query_string=True, unless=lambda: current_user.is_authenticated)  # logged-in users see personalised navigation
 def get_all_posts():
-    posts = BlogPost.query.all()[::-1]
-    return render_template("index.html", all_posts=posts)
+    # Fetch one page of posts, newest first, with each post's author loaded in the same query
+    pagination = db.paginate(
+        select(BlogPost).options(joinedload(BlogPost.author)).order_by(BlogPost.id.desc()),
+        page=request.args.get("page", 1, type=int),
+        per_page=10,
+    )
+    return render_template("index.html", pagination=pagination)
 
 
 @app.route('/register', methods=["POST", "GET"])
 def register():
     form = RegisterForm()
-    if request.method == "GET":
-        return render_template("register.html", form=form)
-    else:
-        if form.validate_on_submit():
+    if form.validate_on_submit():
 
+        # Check if email is already registered
+        if db.session.execute(select(User.id).where(func.lower(User.email) == form.email.data.lower())).first():
+            # Generate error message with wtforms
+            form.email.errors.append("An account is already registered using this email")
+
+        else:
             # Modify response in POST form
             data = form.data  # retrieve input data as dictionary
             del data['csrf_token'], data['submit']  # remove unnecessary data from dictionary
 
             # Hash password
-            data['password'] = bcrypt.generate_password_hash(password=data['password'], rounds=12).decode('utf-8')
+            data['password'] = ph.hash(data['password'])
+
+            # Precompute the gravatar hash so comment avatars don't need it per render
+            data['gravatar_hash'] = hashlib.md5(data['email'].strip().lower().encode('utf-8')).hexdigest()
+
+            # The first account registered on the blog becomes its admin
+            data['is_admin'] = db.session.execute(select(User.id).limit(1)).first() is None
 
             entry = User(**data)  # Create user entry
             db.session.add(entry)  # Add user to database
@@ -140,48 +204,40 @@ def register():
 
             return redirect(url_for('get_all_posts'))
 
-        # Redirects user back to registration page if input is not valid (show error message)
-        else:
-            return render_template("register.html", form=form)
+    # Show the registration page, with error messages if the submitted input was not valid
+    return render_template("register.html", form=form)
 
 
 @app.route('/login', methods = ["POST", "GET"])
 def login():
     form = LoginForm()
-    if request.method == "GET":
-        return render_template("login.html", form=form)
-    elif request.method == "POST":
-        # check if input is valid
-        if form.validate_on_submit():
-
-            # Check if email is registered
-            entry = User.query.filter_by(email=form.email.data).first()
-            if entry:
+    # check if input is valid
+    if form.validate_on_submit():
 
-                # Check if password is valid:
-                if bcrypt.check_password_hash(entry.password, form.password.data):
+        # Check if email is registered
+        entry = db.session.execute(
+            select(User)
+            .where(func.lower(User.email) == form.email.data.lower())
+            .options(load_only(User.id, User.password, User.name))
+        ).scalar_one_or_none()
 
-                    # Login user
-                    login_user(entry)
+        # If email isn't found in database, generate error message with wtforms
+        if not entry:
+            form.email.errors.append("No account registered using this email")
 
-                    # Redirect user to homepage
-                    return redirect(url_for('get_all_posts'))
+        # If password is invalid, generate error message with wtforms
+        elif not verify_password(entry, form.password.data):
+            form.password.errors.append("Invalid password.")
 
-                # If password is invalid:
-                else:
-                    # Generate error message with wtforms
-                    form.password.errors.append("Invalid password.")
-                    return render_template("login.html", form=form)
+        else:
+            # Login user
+            login_user(entry)
 
-            # If email isn't found in database:
-            else:
-                # Generate error message with wtforms
-                form.email.errors.append("No account registered using this email")
-                return render_template("login.html", form=form)
+            # Redirect user to homepage
+            return redirect(url_for('get_all_posts'))
 
-        # Redirect back to login page with wtforms error message
-        else:
-            return render_template("login.html", form=form)
+    # Show the login page, with wtforms error messages if the submitted input was not valid
+    return render_template("login.html", form=form)
 
 
 @app.route('/logout')
@@ -192,25 +248,36 @@ def logout():
 
 @app.route("/post/<int:post_id>", methods=["POST", "GET"])
 def show_post(post_id):
-    requested_post = BlogPost.query.get(post_id)
+    # Load everything the template needs up front; any other relationship access raises instead of querying
+    requested_post = db.session.execute(
+        select(BlogPost).where(BlogPost.id == post_id).options(
+            joinedload(BlogPost.author),
+            selectinload(BlogPost.comments).joinedload(Comment.author),
+            raiseload("*"),
+        )
+    ).unique().scalar_one_or_none()
+    if requested_post is None:
+        return abort(404)
+
     comment_form = CommentForm()
 
     if request.method == "GET":
-        return render_template("post.html", post=requested_post, form=comment_form)
+        # Stream the page so the header reaches the browser while a long post body is still rendering
+        return stream_template("post.html", post=requested_post, form=comment_form)
 
     elif request.method == "POST":
 
         if current_user.is_authenticated:
-            new_comment = Comment(
+            # Plain INSERT; the comment object is never needed since the page is reloaded below
+            db.session.execute(insert(Comment).values(
                 text=comment_form.text.data,
-                b_post=requested_post,
-                author=current_user,
-            )
-            db.session.add(new_comment)
+                blog_id=post_id,
+                author_id=current_user.id,
+            ))
             db.session.commit()
 
-        comment_form = CommentForm()
-        return render_template("post.html", post=requested_post, form=comment_form)
+        # Reload the page so the new comment is fetched with the same eager loading
+        return redirect(url_for("show_post", post_id=post_id))
 
 @app.route("/about")
 def about():
@@ -221,6 +288,7 @@ def contact():
     return render_template("contact.html")
 
 @app.route("/new-post", methods=["GET", "POST"])
+@admin_only
 def add_new_post():
     form = CreatePostForm()
     if request.method == "POST":
@@ -231,10 +299,11 @@ def add_new_post():
                 body=form.body.data,
                 img_url=form.img_url.data,
                 author=current_user,
-                date=date.today().strftime("%B %d, %Y")
+                date=date.today()
             )
             db.session.add(new_post)
             db.session.commit()
+            clear_page_cache()
             return redirect(url_for("get_all_posts"))
     else:
         return render_template("make-post.html", form=form)
@@ -242,23 +311,25 @@ def add_new_post():
 @app.route("/edit-post/<int:post_id>", methods=["GET", "POST"])
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = db.get_or_404(BlogPost, post_id)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
         img_url=post.img_url,
-        author=post.author,
         body=post.body
     )
     if request.method=="POST":
         if edit_form.validate_on_submit():
-            post.title = edit_form.title.data
-            post.subtitle = edit_form.subtitle.data
-            post.img_url = edit_form.img_url.data
-            post.author = current_user
-            post.body = edit_form.body.data
+            db.session.execute(update(BlogPost).where(BlogPost.id == post_id).values(
+                title=edit_form.title.data,
+                subtitle=edit_form.subtitle.data,
+                img_url=edit_form.img_url.data,
+                author_id=current_user.id,
+                body=edit_form.body.data,
+            ))
             db.session.commit()
-            return redirect(url_for("show_post", post_id=post.id))
+            clear_page_cache()
+            return redirect(url_for("show_post", post_id=post_id))
         else:
             return render_template("make-post.html", form=edit_form)
     else:
@@ -267,9 +338,10 @@ def edit_post(post_id):
 @app.route("/delete/<int:post_id>")
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = db.get_or_404(BlogPost, post_id)
     db.session.delete(post_to_delete)
     db.session.commit()
+    clear_page_cache()
     return redirect(url_for('get_all_posts'))
 
 
@@ -0,0 +1,2 @@
+-- Case-insensitive unique index backing the login lookup
+CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email_lower ON users (lower(email));
@@ -0,0 +1,3 @@
+-- Admin flag replacing the hard-coded "user id 1 is the admin" check
+ALTER TABLE users ADD COLUMN IF NOT EXISTS is_admin BOOLEAN NOT NULL DEFAULT FALSE;
+UPDATE users SET is_admin = TRUE WHERE id = 1;
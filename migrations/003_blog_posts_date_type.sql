@@ -0,0 +1,3 @@
+-- Store post dates as DATE instead of a formatted "Month DD, YYYY" string
+ALTER TABLE blog_posts ALTER COLUMN date TYPE DATE USING to_date(date, 'Month DD, YYYY');
+CREATE INDEX IF NOT EXISTS ix_blog_posts_date ON blog_posts (date);
@@ -0,0 +1,4 @@
+-- Precomputed gravatar hash replacing the Flask-Gravatar filter
+ALTER TABLE users ADD COLUMN IF NOT EXISTS gravatar_hash VARCHAR(32);
+UPDATE users SET gravatar_hash = md5(lower(trim(email))) WHERE gravatar_hash IS NULL;
+ALTER TABLE users ALTER COLUMN gravatar_hash SET NOT NULL;
@@ -0,0 +1,90 @@
+import contextlib
+import hashlib
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import event
+
+# main builds its app at import time, so point it at a throwaway SQLite database first
+os.environ['internal'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'blog.db')
+os.environ.pop('REDIS_URL', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture
+def app():
+    main.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with main.app.app_context():
+        main.db.create_all()
+    yield main.app
+    with main.app.app_context():
+        main.db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def count_queries(app):
+    """Context manager collecting the SQL statements run inside it: `with count_queries() as q: client.get('/')`"""
+    with app.app_context():
+        engine = main.db.engine
+
+    @contextlib.contextmanager
+    def counter():
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+    return counter
+
+
+def make_user(email, name, password='password', is_admin=False):
+    return main.User(
+        email=email,
+        name=name,
+        password=main.ph.hash(password),
+        is_admin=is_admin,
+        gravatar_hash=hashlib.md5(email.strip().lower().encode('utf-8')).hexdigest(),
+    )
+
+
+@pytest.fixture
+def blog(app):
+    """Seeds 12 posts by two authors; the newest post has comments from three different users. Returns the post ids"""
+    with app.app_context():
+        authors = [make_user('admin@example.com', 'Admin', is_admin=True), make_user('writer@example.com', 'Writer')]
+        readers = [make_user(f'reader{i}@example.com', f'Reader {i}') for i in range(3)]
+        main.db.session.add_all(authors + readers)
+
+        posts = [
+            main.BlogPost(
+                title=f'Post {i}',
+                subtitle='Subtitle',
+                body='<p>Body</p>',
+                img_url='https://example.com/img.jpg',
+                date=main.date.today(),
+                author=authors[i % 2],
+            )
+            for i in range(12)
+        ]
+        main.db.session.add_all(posts)
+        main.db.session.add_all(
+            main.Comment(text=f'<p>Comment {i}</p>', b_post=posts[-1], author=readers[i % 3])
+            for i in range(6)
+        )
+        main.db.session.commit()
+        return [post.id for post in posts]
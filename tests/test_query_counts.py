@@ -0,0 +1,41 @@
+"""Query-count fences: each page must stay at a fixed number of queries however many rows it shows."""
+
+
+def test_index_page_queries(client, count_queries, blog):
+    with count_queries() as queries:
+        response = client.get('/')
+    assert response.status_code == 200
+    assert b'Post 11' in response.data
+    assert len(queries) <= 2  # page of posts with authors joined, plus the pagination count
+
+
+def test_second_index_page_queries(client, count_queries, blog):
+    with count_queries() as queries:
+        response = client.get('/?page=2')
+    assert response.status_code == 200
+    assert b'Post 0' in response.data
+    assert len(queries) <= 2
+
+
+def test_post_page_queries(client, count_queries, blog):
+    with count_queries() as queries:
+        response = client.get(f'/post/{blog[-1]}')
+    assert response.status_code == 200
+    for i in range(3):
+        assert f'Reader {i}'.encode() in response.data
+    assert len(queries) <= 2  # post with author joined, plus comments with their authors
+
+
+def test_login_lookup_is_one_slim_case_insensitive_select(client, count_queries, blog):
+    with count_queries() as queries:
+        response = client.post('/login', data={'email': 'Admin@Example.COM', 'password': 'password'})
+    assert response.status_code == 302
+
+    assert len(queries) == 1
+    select_list, _, _ = queries[0].partition('FROM')
+    assert select_list.startswith('SELECT')
+    columns = {column.strip() for column in select_list[len('SELECT'):].split(',')}
+    assert columns == {'users.id', 'users.password', 'users.name'}
+
+    # The session now belongs to the admin, so the index shows the admin-only controls
+    assert b'Create New Post' in client.get('/').data